@@ -1,10 +1,18 @@
+import asyncio
+import hashlib
+import hmac
+import logging
 import os
 import re
 import secrets
 import string
-from typing import Dict, List, Optional, Set
+import time
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Set
 
+from cachetools import TTLCache
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.constants import ParseMode
 from telegram.ext import (
@@ -16,47 +24,122 @@ from telegram.ext import (
     filters,
 )
 
-# ✅ مهم: للهروب من مشاكل Markdown
-from telegram.helpers import escape_markdown
+# ✅ مهم: للهروب من مشاكل Markdown — جدول translate جاهز: مسح واحد بدل ~18 مسح في escape_markdown
+_MD2_ESCAPE_TABLE = str.maketrans({c: "\\" + c for c in "\\_*[]()~`>#+-=|{}.!"})
 
-# ✅ تخزين دائم على Volume (/data)
-import json
+
+def _escape_md2(s: Optional[str]) -> str:
+    return (s or "").translate(_MD2_ESCAPE_TABLE)
+
+# ✅ تخزين دائم على Volume (/data) — orjson أسرع بكثير من json القياسي
+import orjson
 from pathlib import Path
 
+# logging مؤجل التنسيق: لو المستوى مرفوع ما تُبنى سلاسل الرسائل أصلاً.
+# uvicorn يضبط loggers تبعه فقط — بدون basicConfig تضيع رسائل INFO التشغيلية
+_LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").strip().upper()
+logging.basicConfig(
+    level=_LOG_LEVEL if _LOG_LEVEL in logging.getLevelNamesMapping() else logging.INFO,
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+log = logging.getLogger("bot")
+
 DATA_DIR = Path(os.environ.get("DATA_DIR", "/data"))
 STATE_FILE = DATA_DIR / "state.json"
 
 
+# mtime آخر تحميل ناجح — حتى يكون استدعاء load_state المتكرر شبه مجاني إذا الملف ما تغيّر
+_last_state_mtime = 0
+
+
 def load_state() -> None:
-    global user_emails, user_last_email, email_owner, blocked_users
+    global user_emails, user_last_email, email_owner, blocked_users, _last_state_mtime
     try:
         DATA_DIR.mkdir(parents=True, exist_ok=True)
         if STATE_FILE.exists():
-            data = json.loads(STATE_FILE.read_text(encoding="utf-8"))
-            user_emails = {int(k): v for k, v in (data.get("user_emails") or {}).items()}
+            m = STATE_FILE.stat().st_mtime_ns
+            if m == _last_state_mtime:
+                return
+            data = orjson.loads(STATE_FILE.read_bytes())
+            # على القرص قوائم، وفي الذاكرة dict محافظ على الترتيب حتى يكون البحث O(1)
+            user_emails = {int(k): dict.fromkeys(v) for k, v in (data.get("user_emails") or {}).items()}
             user_last_email = {int(k): v for k, v in (data.get("user_last_email") or {}).items()}
             email_owner = (data.get("email_owner") or {})
             blocked_users = set(int(x) for x in (data.get("blocked_users") or []))
+            _last_state_mtime = m
     except Exception as e:
-        print("load_state error:", repr(e))
+        log.error("load_state error: %r", e)
         user_emails = {}
         user_last_email = {}
         email_owner = {}
         blocked_users = set()
 
 
-def save_state() -> None:
+def _atomic_write_bytes(path: Path, payload: bytes) -> None:
+    # كتابة على ملف مؤقت ثم os.replace حتى لا يبقى state.json ناقص لو صار انهيار
+    tmp = path.with_suffix(".json.tmp")
+    with open(tmp, "wb", buffering=65536) as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _serialize_state() -> bytes:
+    # OPT_NON_STR_KEYS يكتب مفاتيح int مباشرة بدون تحويلها يدوياً إلى str
+    data = {
+        "user_emails": {k: list(v) for k, v in user_emails.items()},
+        "user_last_email": user_last_email,
+        "email_owner": email_owner,
+        "blocked_users": sorted(blocked_users),
+    }
+    return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
+
+def _write_state_bytes(payload: bytes) -> None:
     try:
         DATA_DIR.mkdir(parents=True, exist_ok=True)
-        data = {
-            "user_emails": {str(k): v for k, v in user_emails.items()},
-            "user_last_email": {str(k): v for k, v in user_last_email.items()},
-            "email_owner": email_owner,
-            "blocked_users": sorted(list(blocked_users)),
-        }
-        STATE_FILE.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        _atomic_write_bytes(STATE_FILE, payload)
     except Exception as e:
-        print("save_state error:", repr(e))
+        log.error("save_state error: %r", e)
+
+
+def _save_state_sync() -> None:
+    try:
+        payload = _serialize_state()
+    except Exception as e:
+        log.error("save_state error: %r", e)
+        return
+    _write_state_bytes(payload)
+
+
+# ✅ بدل الكتابة على القرص مع كل تعديل: علامة dirty + مهمة خلفية تجمع الكتابات
+_state_dirty: Optional[asyncio.Event] = None
+
+
+def save_state() -> None:
+    # داخل الحدث loop نكتفي بوضع العلامة، والمهمة الخلفية تتكفل بالكتابة
+    if _state_dirty is not None:
+        _state_dirty.set()
+    else:
+        _save_state_sync()
+
+
+async def _state_flusher() -> None:
+    assert _state_dirty is not None
+    while True:
+        await _state_dirty.wait()
+        _state_dirty.clear()
+        # نمهل قليلاً حتى تتجمع التعديلات المتتالية في كتابة واحدة
+        await asyncio.sleep(2.0)
+        # اللقطة تؤخذ على خيط الحلقة حتى ما تتغير القواميس أثناء التسلسل،
+        # والكتابة للقرص وحدها تروح على خيط منفصل
+        try:
+            snapshot = _serialize_state()
+        except Exception as e:
+            log.error("state snapshot error: %r", e)
+            continue
+        await asyncio.to_thread(_write_state_bytes, snapshot)
 
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "").strip()
@@ -69,7 +152,14 @@ if not TG_WEBHOOK_PATH.startswith("/"):
     TG_WEBHOOK_PATH = "/" + TG_WEBHOOK_PATH
 
 TG_SECRET_TOKEN = os.environ.get("TG_SECRET_TOKEN", "").strip()
+# جاهزة مسبقاً للمقارنة الثابتة الوقت في كل تحديث
+_TG_SECRET_BYTES = TG_SECRET_TOKEN.encode()
+_TG_SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
 MAILGUN_WEBHOOK_SECRET = os.environ.get("MAILGUN_WEBHOOK_SECRET", "").strip()
+_MAILGUN_SECRET_BYTES = MAILGUN_WEBHOOK_SECRET.encode()
+# أقصى عمر مقبول لطابع توقيع Mailgun — بعده نعتبر الطلب إعادة إرسال
+_MAILGUN_SIG_MAX_AGE = 120
 
 OWNER_ID_RAW = os.environ.get("OWNER_ID", "").strip()
 OWNER_ID: Optional[int] = int(OWNER_ID_RAW) if OWNER_ID_RAW.isdigit() else None
@@ -77,9 +167,10 @@ OWNER_ID: Optional[int] = int(OWNER_ID_RAW) if OWNER_ID_RAW.isdigit() else None
 if not BOT_TOKEN:
     raise RuntimeError("Missing BOT_TOKEN env var")
 
-user_emails: Dict[int, List[str]] = {}
+user_emails: Dict[int, Dict[str, None]] = {}
 user_last_email: Dict[int, str] = {}
-waiting_for_name: Set[int] = set()
+# TTL حتى ما يكبر بلا حدود لو ضغط المستخدم "اختر اسم" وما أرسل شيئاً
+waiting_for_name: TTLCache = TTLCache(maxsize=10_000, ttl=600)
 email_owner: Dict[str, int] = {}
 
 # ✅ (إضافة فقط) حظر/فك حظر
@@ -107,89 +198,121 @@ def parse_target_user_id(text: str) -> Optional[int]:
         return None
 
 
-def admin_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🚫 حظر شخص", callback_data="admin_block")],
-        [InlineKeyboardButton("✅ فك حظر شخص", callback_data="admin_unblock")],
-        [InlineKeyboardButton("🔙 عودة", callback_data="back")],
-    ])
+# ✅ الكيبوردات ثابتة — نبنيها مرة واحدة عند الاستيراد بدل كل ضغطة زر
+_ADMIN_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🚫 حظر شخص", callback_data="admin_block")],
+    [InlineKeyboardButton("✅ فك حظر شخص", callback_data="admin_unblock")],
+    [InlineKeyboardButton("🔙 عودة", callback_data="back")],
+])
+
+_BACK_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 عودة", callback_data="back")]])
+
+_ADMIN_BACK_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="admin_menu")]])
+
+
+# كل فراغات يونيكود التي يطابقها \s — جدول ASCII فقط كان يغيّر ناتج أسماء قديمة
+_WS_CHARS = (
+    " \t\n\r\v\f\x1c\x1d\x1e\x1f\x85\xa0\u1680"
+    "\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a"
+    "\u2028\u2029\u202f\u205f\u3000"
+)
+_SANI_TABLE = str.maketrans(dict.fromkeys(_WS_CHARS, "."))
+_RE_BAD = re.compile(r"[^a-z0-9._-]")
+_RE_DOTS = re.compile(r"\.+")
 
 
 def sanitize_local_part(raw: str) -> str:
-    s = raw.strip().lower()
-    s = re.sub(r"\s+", ".", s)
-    s = re.sub(r"[^a-z0-9._-]", "", s)
-    s = re.sub(r"\.+", ".", s).strip(".")
+    # lower() أولاً (يغطي حالات يونيكود مثل İ) ثم جدول الفراغات في مسح C واحد
+    s = raw.strip().lower().translate(_SANI_TABLE)
+    s = _RE_BAD.sub("", s)
+    s = _RE_DOTS.sub(".", s).strip(".")
     return s[:32]
 
 
+_LOCAL_ALPHABET = string.ascii_lowercase + string.digits  # 36 حرفاً
+
+
 def random_local_part(length: int = 10) -> str:
-    alphabet = string.ascii_lowercase + string.digits
-    return "".join(secrets.choice(alphabet) for _ in range(length))
+    # سحبة urandom واحدة بدل استدعاء secrets.choice لكل حرف،
+    # مع رفض القيم >= 252 (= 7 * 36) حتى يبقى التوزيع غير منحاز
+    out: List[str] = []
+    while len(out) < length:
+        for b in secrets.token_bytes(length * 2):
+            if b < 252:
+                out.append(_LOCAL_ALPHABET[b % 36])
+                if len(out) == length:
+                    break
+    return "".join(out)
 
 
+@lru_cache(maxsize=4096)
 def make_email(local_part: str) -> str:
     return f"{local_part}@{DOMAIN}"
 
 
 def remember_email(user_id: int, email: str) -> None:
-    lst = user_emails.setdefault(user_id, [])
-    if email not in lst:
-        lst.append(email)
+    user_emails.setdefault(user_id, {})[email] = None
     user_last_email[user_id] = email
     email_owner[email] = user_id
     save_state()
 
 
+# نص الترحيب ثابت — نبنيه مرة واحدة، والقالب مع البريد يعبّأ بـ % (أسرع من f-string متكرر)
+_START_BASE = (
+    "مرحباً بك في بوت البريد المؤقت ✉️\n"
+    "استخدم هذا البوت لإنشاء بريد إلكتروني مؤقت للتسجيل في المواقع دون الكشف عن بريدك الحقيقي."
+)
+_START_WITH_LAST = _START_BASE + "\n\nبريدك الحالي:\n`%s`"
+
+
+# دالة نقية بالبريد الأخير فقط — الكاش يخلي ضغطات back المتكررة مجرد dict lookup
+@lru_cache(maxsize=10_000)
 def start_text(last_email: Optional[str]) -> str:
-    base = (
-        "مرحباً بك في بوت البريد المؤقت ✉️\n"
-        "استخدم هذا البوت لإنشاء بريد إلكتروني مؤقت للتسجيل في المواقع دون الكشف عن بريدك الحقيقي."
-    )
-    if last_email:
-        return f"{base}\n\nبريدك الحالي:\n`{last_email}`"
-    return base
+    return (_START_WITH_LAST % last_email) if last_email else _START_BASE
 
 
-def main_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("✏️ اختر اسم", callback_data="choose_name")],
-        [InlineKeyboardButton("🎲 إنشاء بريد عشوائي", callback_data="random_email")],
-        [InlineKeyboardButton("📋 انسخ البريد الإلكتروني", callback_data="copy_email")],
-        [InlineKeyboardButton("📁 بريدي الخاص", callback_data="my_emails")],
-    ])
+_MAIN_ROWS = [
+    [InlineKeyboardButton("✏️ اختر اسم", callback_data="choose_name")],
+    [InlineKeyboardButton("🎲 إنشاء بريد عشوائي", callback_data="random_email")],
+    [InlineKeyboardButton("📋 انسخ البريد الإلكتروني", callback_data="copy_email")],
+    [InlineKeyboardButton("📁 بريدي الخاص", callback_data="my_emails")],
+]
+_MAIN_KB = InlineKeyboardMarkup(_MAIN_ROWS)
+_MAIN_KB_ADMIN = InlineKeyboardMarkup(_MAIN_ROWS + [[InlineKeyboardButton("🛠️ Admin", callback_data="admin_menu")]])
 
 
 # ✅ (إضافة فقط) نفس الكيبورد + زر الأدمن يظهر للأدمن فقط
 def main_keyboard_for(uid: int) -> InlineKeyboardMarkup:
-    rows = [
-        [InlineKeyboardButton("✏️ اختر اسم", callback_data="choose_name")],
-        [InlineKeyboardButton("🎲 إنشاء بريد عشوائي", callback_data="random_email")],
-        [InlineKeyboardButton("📋 انسخ البريد الإلكتروني", callback_data="copy_email")],
-        [InlineKeyboardButton("📁 بريدي الخاص", callback_data="my_emails")],
-    ]
-    if is_admin(uid):
-        rows.append([InlineKeyboardButton("🛠️ Admin", callback_data="admin_menu")])
-    return InlineKeyboardMarkup(rows)
+    return _MAIN_KB_ADMIN if is_admin(uid) else _MAIN_KB
+
+
+def format_my_emails(emails: Iterable[str]) -> str:
+    return "📁 بريداتي:\n" + "\n".join(f"• `{e}`" for e in emails)
+
+
+# أقصى عدد بريدات نعرضه في رسالة "بريدي الخاص"
+_MY_EMAILS_LIMIT = 50
 
 
-def format_my_emails(emails: List[str]) -> str:
-    lines = ["📁 بريداتي:"]
-    for e in emails:
-        lines.append(f"• `{e}`")
-    return "\n".join(lines)
+# المفتاح محتوى القائمة نفسه، فالضغطات المتكررة على "بريدي الخاص" ما تعيد البناء،
+# وإضافة بريد جديد تعني مفتاحاً جديداً تلقائياً
+@lru_cache(maxsize=5_000)
+def _render_my_emails(emails: tuple) -> str:
+    return format_my_emails(emails)
 
 
 def format_inbound_message(to_email: str, sender: str, subject: str, body: str) -> str:
-    body = (body or "").strip()
+    # نقصّ أولاً ثم strip حتى لا نمسح نص ضخم كاملاً قبل القص
+    body = body or ""
     if len(body) > 3500:
         body = body[:3500] + "\n…"
+    body = body.strip()
 
     # ✅ Escape Markdown حتى ما تفشل الرسالة
-    to_email_e = escape_markdown(to_email or "", version=2)
-    sender_e = escape_markdown(sender or "", version=2)
-    subject_e = escape_markdown(subject or "", version=2)
-    body_e = escape_markdown(body or "(بدون نص)", version=2)
+    to_email_e = _escape_md2(to_email)
+    sender_e = _escape_md2(sender)
+    subject_e = _escape_md2(subject)
+    body_e = _escape_md2(body or "(بدون نص)")
 
     return (
         "📩 وصلت رسالة جديدة\n\n"
@@ -200,21 +323,17 @@ def format_inbound_message(to_email: str, sender: str, subject: str, body: str)
     )
 
 
-_EMAIL_RE = re.compile(r"([a-z0-9._%+\-]+@[a-z0-9.\-]+\.[a-z]{2,})", re.IGNORECASE)
+# بدون IGNORECASE وبدون مجموعة التقاط: نخفّض الحالة مرة واحدة و findall يرجّع النصوص مباشرة
+_EMAIL_RE = re.compile(rb"[a-z0-9._%+\-]+@[a-z0-9.\-]+\.[a-z]{2,}")
 
 
 def extract_emails(text: str) -> List[str]:
-    if not text:
+    # فحص سريع قبل تشغيل الـ regex: بدون @ ما في إيميلات أصلاً
+    if not text or "@" not in text:
         return []
-    found = _EMAIL_RE.findall(text)
-    seen = set()
-    out: List[str] = []
-    for e in found:
-        e2 = e.strip().lower()
-        if e2 and e2 not in seen:
-            seen.add(e2)
-            out.append(e2)
-    return out
+    found = _EMAIL_RE.findall(text.lower().encode())
+    # dict.fromkeys = إزالة التكرار مع حفظ الترتيب على مستوى C
+    return [e.decode() for e in dict.fromkeys(found)]
 
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -250,7 +369,7 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not is_admin(uid):
             await q.answer("غير مصرح", show_alert=True)
             return
-        await q.edit_message_text("🛠️ لوحة الأدمن:", reply_markup=admin_keyboard())
+        await q.edit_message_text("🛠️ لوحة الأدمن:", reply_markup=_ADMIN_KB)
         return
 
     # ✅ (إضافة فقط) حظر شخص
@@ -262,7 +381,7 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         admin_waiting_unblock.discard(uid)
         await q.edit_message_text(
             "🚫 أرسل الآن ID الشخص المراد حظره:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="admin_menu")]]),
+            reply_markup=_ADMIN_BACK_KB,
         )
         return
 
@@ -275,30 +394,33 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         admin_waiting_block.discard(uid)
         await q.edit_message_text(
             "✅ أرسل الآن ID الشخص المراد فك حظره:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="admin_menu")]]),
+            reply_markup=_ADMIN_BACK_KB,
         )
         return
 
     if data == "choose_name":
-        waiting_for_name.add(uid)
+        waiting_for_name[uid] = True
         await q.edit_message_text("✏️ اكتب الاسم الذي تريد استخدامه للبريد:")
         return
 
     if data == "random_email":
-        email = make_email(random_local_part())
-
         # ✅ (إضافة فقط) منع التصادم/سرقة الإيميل: إذا محجوز لغيرك ولّد غيره
-        while True:
-            existing_owner = email_owner.get(email)
+        # محاولات محدودة (التصادم شبه مستحيل مع 36^10 عنوان) ومرجع محلي للـ get داخل الحلقة
+        owner_get = email_owner.get
+        for _ in range(8):
+            email = f"{random_local_part()}@{DOMAIN}"
+            existing_owner = owner_get(email)
             if not existing_owner or existing_owner == uid:
                 break
-            email = make_email(random_local_part())
+        else:
+            await q.answer("❌ حصل خطأ، حاول مرة أخرى.", show_alert=True)
+            return
 
         remember_email(uid, email)
         await q.edit_message_text(
             f"تم إنشاء بريد إلكتروني جديد ✅\n\n- البريد الإلكتروني الجديد:\n`{email}`",
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 عودة", callback_data="back")]]),
+            reply_markup=_BACK_KB,
         )
         return
 
@@ -307,24 +429,25 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not last:
             await q.edit_message_text(
                 "❌ لم يتم إنشاء بريد بعد",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 عودة", callback_data="back")]]),
+                reply_markup=_BACK_KB,
             )
             return
         await q.message.reply_text(f"`{last}`", parse_mode=ParseMode.MARKDOWN)
         return
 
     if data == "my_emails":
-        emails = user_emails.get(uid, [])
+        # آخر 50 فقط: رسالة تيليجرام محدودة بـ 4096 حرفاً
+        emails = list(user_emails.get(uid) or {})[-_MY_EMAILS_LIMIT:]
         if not emails:
             await q.edit_message_text(
                 "📁 لا يوجد بريدات تم إنشاؤها بعد.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 عودة", callback_data="back")]]),
+                reply_markup=_BACK_KB,
             )
             return
         await q.edit_message_text(
-            format_my_emails(emails),
+            _render_my_emails(tuple(emails)),
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 عودة", callback_data="back")]]),
+            reply_markup=_BACK_KB,
         )
         return
 
@@ -380,7 +503,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not local:
         await update.message.reply_text("❌ الاسم غير صالح. حاول مرة أخرى:")
         return
-    waiting_for_name.discard(uid)
+    waiting_for_name.pop(uid, None)
     email = make_email(local)
 
     # ✅ (إضافة فقط) منع استخدام نفس الإيميل لشخص ثاني
@@ -393,19 +516,90 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         f"تم إنشاء بريد إلكتروني جديد ✅\n\n- البريد الإلكتروني الجديد:\n`{email}`",
         parse_mode=ParseMode.MARKDOWN,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 عودة", callback_data="back")]]),
+        reply_markup=_BACK_KB,
     )
 
 
-app = FastAPI()
+# ✅ ردود JSON عبر orjson بدل مشفّر Starlette الافتراضي
+app = FastAPI(default_response_class=ORJSONResponse)
 tg_app: Optional[Application] = None
+_flusher_task: Optional[asyncio.Task] = None
+
+# ✅ طابور إرسال محدود + عمال يحترمون حدود تيليجرام (30 رسالة/ثانية عامة، 1/ثانية لكل محادثة)
+_SEND_QUEUE_MAX = 10_000
+_SEND_WORKERS = 4
+_GLOBAL_SEND_INTERVAL = 1.0 / 30.0
+_PER_CHAT_SEND_INTERVAL = 1.0
+
+send_queue: Optional[asyncio.Queue] = None
+_sender_tasks: List[asyncio.Task] = []
+
+# مهام معالجة تحديثات تيليجرام: مراجع قوية + حد للتوازي حتى ما تنفجر مع رشقة تحديثات
+_UPDATE_CONCURRENCY = 32
+_update_tasks: Set[asyncio.Task] = set()
+_update_semaphore: Optional[asyncio.Semaphore] = None
+
+
+async def _process_update_bounded(update: Update) -> None:
+    async with _update_semaphore:
+        await tg_app.process_update(update)
+_rate_lock: Optional[asyncio.Lock] = None
+_next_global_slot = 0.0
+_next_chat_slot: Dict[int, float] = {}
+
+
+async def _reserve_send_slot(chat_id: int) -> float:
+    # يحجز أقرب وقت إرسال مسموح ضمن الحدين العام والخاص بالمحادثة
+    global _next_global_slot
+    async with _rate_lock:
+        now = asyncio.get_running_loop().time()
+        # التوكن العام يتقدم بمعزل عن تأخير المحادثة — لو كتبنا فتحة محادثة
+        # مزدحمة في المؤشر العام صار تباعد 1/ثانية يسري على كل المحادثات
+        g = max(now, _next_global_slot)
+        _next_global_slot = g + _GLOBAL_SEND_INTERVAL
+        slot = max(g, _next_chat_slot.get(chat_id, 0.0))
+        _next_chat_slot[chat_id] = slot + _PER_CHAT_SEND_INTERVAL
+        # تنظيف الفتحات المنتهية حتى ما يكبر القاموس بلا حدود
+        if len(_next_chat_slot) > 4096:
+            for cid in [cid for cid, t in _next_chat_slot.items() if t <= now]:
+                del _next_chat_slot[cid]
+        return slot
+
+
+async def _sender_worker() -> None:
+    while True:
+        chat_id, text = await send_queue.get()
+        try:
+            slot = await _reserve_send_slot(chat_id)
+            delay = slot - asyncio.get_running_loop().time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await tg_app.bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                parse_mode=ParseMode.MARKDOWN_V2,  # ✅ صار آمن بعد escape
+                disable_web_page_preview=True,
+            )
+        except Exception as e:
+            log.warning("Telegram send_message error: %r", e)
+        finally:
+            send_queue.task_done()
 
 
 @app.on_event("startup")
 async def startup():
-    global tg_app
+    global tg_app, _state_dirty, _flusher_task, send_queue, _rate_lock, _update_semaphore
     load_state()
 
+    _state_dirty = asyncio.Event()
+    _flusher_task = asyncio.create_task(_state_flusher())
+
+    send_queue = asyncio.Queue(maxsize=_SEND_QUEUE_MAX)
+    _rate_lock = asyncio.Lock()
+    _update_semaphore = asyncio.Semaphore(_UPDATE_CONCURRENCY)
+    for _ in range(_SEND_WORKERS):
+        _sender_tasks.append(asyncio.create_task(_sender_worker()))
+
     tg_app = Application.builder().token(BOT_TOKEN).build()
     tg_app.add_handler(CommandHandler("start", cmd_start))
     tg_app.add_handler(CallbackQueryHandler(on_button))
@@ -421,9 +615,9 @@ async def startup():
             secret_token=TG_SECRET_TOKEN if TG_SECRET_TOKEN else None,
             drop_pending_updates=True,
         )
-        print("Telegram webhook set to:", webhook_url)
+        log.info("Telegram webhook set to: %s", webhook_url)
     else:
-        print("WARNING: PUBLIC_URL is empty, webhook not set!")
+        log.warning("PUBLIC_URL is empty, webhook not set!")
 
     if OWNER_ID:
         try:
@@ -437,16 +631,30 @@ async def startup():
                 disable_web_page_preview=True,
             )
         except Exception as e:
-            print("Owner notify error:", repr(e))
+            log.warning("Owner notify error: %r", e)
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    global _state_dirty
+    if _flusher_task:
+        _flusher_task.cancel()
+        # ننتظرها فعلاً: الإلغاء ما يقطع كتابة to_thread الجارية، ولو ما انتظرنا
+        # ممكن تتداخل كتابتها مع الكتابة الأخيرة أدناه على نفس الملف المؤقت
+        try:
+            await _flusher_task
+        except asyncio.CancelledError:
+            pass
+    for t in _sender_tasks:
+        t.cancel()
+    # آخر كتابة قبل الإغلاق حتى لا نفقد التعديلات المؤجلة
+    _state_dirty = None
+    _save_state_sync()
     if tg_app:
         try:
             await tg_app.bot.delete_webhook(drop_pending_updates=True)
         except Exception as e:
-            print("delete_webhook error:", repr(e))
+            log.warning("delete_webhook error: %r", e)
         await tg_app.stop()
         await tg_app.shutdown()
 
@@ -467,26 +675,92 @@ async def telegram_webhook(request: Request):
         raise HTTPException(status_code=500, detail="Bot not ready")
 
     if TG_SECRET_TOKEN:
-        hdr = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
-        if hdr != TG_SECRET_TOKEN:
+        hdr = request.headers.get(_TG_SECRET_HEADER, "")
+        if not hmac.compare_digest(hdr.encode(), _TG_SECRET_BYTES):
             raise HTTPException(status_code=403, detail="Bad telegram secret token")
 
-    data = await request.json()
+    # orjson.loads أسرع من request.json() المبني على json القياسي
+    data = orjson.loads(await request.body())
     update = Update.de_json(data, tg_app.bot)
-    await tg_app.update_queue.put(update)
+    # معالجة مباشرة بدل المرور على update_queue: نرجّع 200 فوراً والتحديث يكمل بالخلفية.
+    # لازم نمسك مرجعاً قوياً للمهمة (اللوب يحتفظ بمرجع ضعيف فقط) وإلا ممكن تُجمع وسط التنفيذ
+    task = asyncio.create_task(_process_update_bounded(update))
+    _update_tasks.add(task)
+    task.add_done_callback(_update_tasks.discard)
     return {"ok": True}
 
 
+# أقصى حجم نقبله من Mailgun — الرسالة تُقص عند 3500 حرف على أي حال
+_MAILGUN_MAX_BODY = 1 << 20
+
+
 @app.post("/mailgun")
 async def mailgun_inbound(request: Request):
     if not tg_app:
         return {"ok": True}
 
-    if MAILGUN_WEBHOOK_SECRET:
-        if request.headers.get("X-Webhook-Secret", "") != MAILGUN_WEBHOOK_SECRET:
-            raise HTTPException(status_code=403, detail="Bad mailgun secret")
+    # نرفض الأجسام الضخمة قبل أي تحليل — ما نحتاج إلا كم حقل صغير من الطلب
+    cl_raw = request.headers.get("content-length")
+    try:
+        content_length = int(cl_raw) if cl_raw is not None else None
+    except ValueError:
+        content_length = None
+    if content_length is not None and content_length > _MAILGUN_MAX_BODY:
+        raise HTTPException(status_code=413, detail="Payload too large")
+
+    # لو Mailgun مضبوط يرسل JSON ناخذ المسار الرخيص بدل تحليل multipart كامل،
+    # ومع multipart نحدّ حجم الجزء الواحد حتى ما يجبرنا أحد على تخزين ميغابايتات
+    ct = request.headers.get("content-type", "")
+    if ct.startswith("application/json"):
+        # نقرأ مع عدّاد: طلب chunked بدون Content-Length ما يتجاوز الحد بالذاكرة
+        chunks: List[bytes] = []
+        received = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > _MAILGUN_MAX_BODY:
+                raise HTTPException(status_code=413, detail="Payload too large")
+            chunks.append(chunk)
+        # JSON مكسور أو جذر غير dict = طلب غلط من النت، 400 وليس 500
+        try:
+            form = orjson.loads(b"".join(chunks))
+        except orjson.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Malformed JSON")
+        if not isinstance(form, dict):
+            raise HTTPException(status_code=400, detail="Malformed JSON")
+    else:
+        # Mailgun يرسل Content-Length دائماً؛ chunked بدون طول يعني multipart بلا سقف
+        # للذاكرة (max_part_size يحد الجزء الواحد فقط) — نرفضه، ونحد عدد الحقول والملفات
+        if content_length is None:
+            raise HTTPException(status_code=411, detail="Content-Length required")
+        form = await request.form(
+            max_part_size=_MAILGUN_MAX_BODY, max_fields=200, max_files=25
+        )
 
-    form = await request.form()
+    # ✅ توقيع Mailgun الرسمي: HMAC-SHA256 على timestamp+token ومقارنة ثابتة الوقت
+    # (hashlib يستخدم تسريع SHA-NI على المعالجات الحديثة)
+    if MAILGUN_WEBHOOK_SECRET:
+        timestamp = str(form.get("timestamp", "") or "")
+        token = str(form.get("token", "") or "")
+        signature = str(form.get("signature", "") or "")
+        if timestamp and token and signature:
+            # طابع قديم أو غير رقمي = إعادة إرسال محتملة لتوقيع ملتقط
+            try:
+                fresh = abs(time.time() - float(timestamp)) <= _MAILGUN_SIG_MAX_AGE
+            except ValueError:
+                fresh = False
+            if not fresh:
+                raise HTTPException(status_code=403, detail="Stale mailgun timestamp")
+            expected = hmac.new(
+                _MAILGUN_SECRET_BYTES, f"{timestamp}{token}".encode(), hashlib.sha256
+            ).hexdigest()
+            # مقارنة bytes — compare_digest على str يرمي TypeError مع توقيع غير ASCII
+            if not hmac.compare_digest(signature.encode(), expected.encode()):
+                raise HTTPException(status_code=403, detail="Bad mailgun signature")
+        else:
+            # توافق مع الإعداد القديم: سر مشترك في هيدر X-Webhook-Secret
+            hdr = request.headers.get("x-webhook-secret", "")
+            if not hmac.compare_digest(hdr.encode(), _MAILGUN_SECRET_BYTES):
+                raise HTTPException(status_code=403, detail="Bad mailgun secret")
 
     recipient_raw = str(form.get("recipient", "") or "")
     to_raw = str(form.get("To", "") or form.get("to", "") or "")
@@ -497,35 +771,41 @@ async def mailgun_inbound(request: Request):
 
     sender = str(form.get("sender", "")).strip()
     subject = str(form.get("subject", "")).strip()
-    body = str(form.get("stripped-text") or form.get("body-plain") or "").strip()
+    # بدون strip هنا — format_inbound_message يقص عند 3500 ثم يعمل strip على الناتج فقط
+    body = str(form.get("stripped-text") or form.get("body-plain") or "")
 
-    print("MAILGUN INBOUND recipients:", recipients, "sender:", sender, "subject:", subject)
+    log.debug("mailgun inbound recipients=%r sender=%r subject=%r", recipients, sender, subject)
 
-    if not recipients:
+    # تقاطع sets على مستوى C بدل get لكل مستلم على حدة
+    owned = email_owner.keys() & set(recipients)
+    if not owned:
         return {"ok": True}
 
-    sent_any = False
-    for to_email in recipients:
-        owner_id = email_owner.get(to_email)
-        if not owner_id:
-            print("No owner for:", to_email)
-            continue
+    # نجمع العناوين حسب المالك ونرسل لكل المالكين بالتوازي
+    by_owner: Dict[int, List[str]] = {}
+    for e in owned:
+        by_owner.setdefault(email_owner[e], []).append(e)
 
-        # ✅ (إضافة فقط) إذا صاحب الإيميل محظور لا يتم إرسال الرسائل له
-        if owner_id in blocked_users and (not OWNER_ID or owner_id != OWNER_ID):
-            print("Blocked owner, skip deliver to:", owner_id, "email:", to_email)
-            continue
+    queued_any = False
+    for owner_id, emails in by_owner.items():
+        if _enqueue_deliveries(owner_id, emails, sender, subject, body):
+            queued_any = True
+    # نرجّع 200 لـ Mailgun فوراً — العمال يتكفلون بالإرسال الفعلي ضمن حدود تيليجرام
+    return {"ok": True, "delivered": queued_any}
 
+
+def _enqueue_deliveries(owner_id: int, to_emails: List[str], sender: str, subject: str, body: str) -> bool:
+    # ✅ (إضافة فقط) إذا صاحب الإيميل محظور لا يتم إرسال الرسائل له
+    if owner_id in blocked_users and (not OWNER_ID or owner_id != OWNER_ID):
+        log.debug("blocked owner, skip deliver to %s emails=%r", owner_id, to_emails)
+        return False
+
+    queued = False
+    for to_email in to_emails:
         msg = format_inbound_message(to_email, sender, subject, body)
         try:
-            await tg_app.bot.send_message(
-                chat_id=owner_id,
-                text=msg,
-                parse_mode=ParseMode.MARKDOWN_V2,  # ✅ صار آمن بعد escape
-                disable_web_page_preview=True,
-            )
-            sent_any = True
-        except Exception as e:
-            print("Telegram send_message error:", repr(e))
-
-    return {"ok": True, "delivered": sent_any}
+            send_queue.put_nowait((owner_id, msg))
+            queued = True
+        except asyncio.QueueFull:
+            log.warning("send queue full, dropping message for %s", owner_id)
+    return queued